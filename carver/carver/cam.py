@@ -1,35 +1,48 @@
 import bpy, bmesh
-from mathutils import Vector, Euler
-import math
-import copy 
+from mathutils import Vector, Euler, Matrix
+from mathutils.bvhtree import BVHTree
+import numpy as np
 from tqdm import tqdm
 import logging
 import sys
 
 sys.path.append('/home/walkenz1/Projects/merlin_ws/src/extras/carver')
-from carver.helpers import bmesh_check_intersect_objects, minimize_objects_angular_distance, pointInsideMesh, ray_cast_from_to
+from carver.helpers import vertex_coords, build_bvh, bvh_intersect, rest_geometry, posed_bvh, posed_bounds, aabb_overlap, angular_order, minimize_objects_angular_distance, inside_mask, ray_cast_from_to
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Diagonal pairs of points around a contour vertex, one of a pair should land on each side of the surface
+NORMAL_SAMPLE_OFFSETS = np.array([[(.5,.5,0), (-.5,-.5,0)], [(-.5,.5,0), (.5,-.5,0)]]) * .25
+
 class CAMTask:
-    def __init__(self, target, tool):
+    def __init__(self, target, tool, bvh=None):
         if not isinstance(target, bpy.types.Object) or not isinstance(tool, bpy.types.Object):
             raise ValueError("Target and tool must be valid Blender objects")
-        self._keypoints = [] 
+        # Keypoints as parallel (N,3) arrays of locations and XYZ euler rotations
+        self._loc = np.empty((0, 3))
+        self._rot = np.empty((0, 3))
         self.TARGET = target
         self.TOOL = tool
         self.TOOL.rotation_mode = "XYZ"
+        # BVH of the target in object space, shared with sub tasks when given
+        if bvh is None:
+            bvh = BVHTree.FromObject(self.TARGET, bpy.context.evaluated_depsgraph_get())
+        self._bvh = bvh
 
     def get_keypoints(self):
-        return copy.deepcopy(self._keypoints)
+        return self._loc, self._rot
+
+    def iter_keypoints(self):
+        for location, rotation_euler in zip(*self.get_keypoints()):
+            yield Vector(location), Euler(rotation_euler, 'XYZ')
 
     def build(self):
         try:
             self._build()
             # self.remove_unreachable_keypoints()
-            logger.info(f"Built {self.__class__.__name__} with {len(self._keypoints)} keypoints")
+            logger.info(f"Built {self.__class__.__name__} with {len(self._loc)} keypoints")
         except Exception as e:
             logger.error(f"Error in building {self.__class__.__name__}: {str(e)}")
             raise
@@ -40,68 +53,100 @@ class CAMTask:
 
     def remove_unreachable_keypoints(self):
         try:
-            original_count = len(self._keypoints)
-            marks = []
-            for location, rotation_euler in tqdm(self._keypoints, desc="Checking reachable keypoints"):
-                bpy.context.view_layer.objects.active = self.TOOL
-                self.TOOL.location = location
-                self.TOOL.rotation_euler = rotation_euler
-                bpy.ops.object.transform_apply(location=True, rotation=True, scale=True)
-                if not bmesh_check_intersect_objects(self.TOOL, self.TARGET):
-                    marks.append((location, rotation_euler))
-            self._keypoints = marks
-            removed_count = original_count - len(self._keypoints)
+            original_count = len(self._loc)
+            reachable = np.ones(original_count, dtype=bool)
+            # The target does not move, only the tool has to be posed per keypoint
+            bm_target, bvh_target = build_bvh(self.TARGET)
+            target_min, target_max = posed_bounds([corner[:] for corner in self.TARGET.bound_box], self.TARGET.matrix_world)
+            tool_verts, tool_polygons = rest_geometry(self.TOOL)
+            tool_bound_box = [corner[:] for corner in self.TOOL.bound_box]
+            for i, (location, rotation_euler) in enumerate(tqdm(zip(self._loc, self._rot), total=original_count, desc="Checking reachable keypoints")):
+                pose = Matrix.LocRotScale(Vector(location), Euler(rotation_euler, 'XYZ'), self.TOOL.scale)
+                # Poses whose box misses the target's box cannot intersect it
+                if not aabb_overlap(*posed_bounds(tool_bound_box, pose), target_min, target_max):
+                    continue
+                bvh_tool = posed_bvh(tool_verts, tool_polygons, pose)
+                reachable[i] = not bvh_intersect(bvh_target, bvh_tool)
+            bm_target.free()
+            self._loc, self._rot = self._loc[reachable], self._rot[reachable]
+            removed_count = original_count - len(self._loc)
             logger.info(f"Removed {removed_count} unreachable keypoints")
         except Exception as e:
             logger.error(f"Error in removing unreachable keypoints: {str(e)}")
             raise
 
 class ContourTrace(CAMTask):
-    def __init__(self, target, tool, center, plane_normal=Vector((0,0,1))):
-        super().__init__(target, tool)
+    def __init__(self, target, tool, center, plane_normal=Vector((0,0,1)), bvh=None):
+        super().__init__(target, tool, bvh=bvh)
         self.center = center
         self.plane_normal = plane_normal
         self.contour = None
+        self._slice = None
           
     def sample_for_normals(self, offset=0):
         try:
-            for vert in tqdm(self.contour.data.vertices, desc="Sampling for normals"):
-                point = Vector((vert.co.x, vert.co.y, vert.co.z))
-                result = [False]
-                for p1, p2 in [((.5,.5,0), (-.5,-.5,0)), ((-.5,.5,0), (.5,-.5,0))]:
-                    v1, v2 = point + Vector(p1) * .25, point + Vector(p2) * .25
-                    if pointInsideMesh(v1, self.TARGET) and not pointInsideMesh(v2, self.TARGET):
-                        result = ray_cast_from_to(v2, v1, self.TARGET)
-                        break
-                    elif pointInsideMesh(v2, self.TARGET) and not pointInsideMesh(v1, self.TARGET):
-                        result = ray_cast_from_to(v1, v2, self.TARGET)
-                        break
-                if result[0]: 
-                    hit, location, normal, face_index = result
+            coords = vertex_coords(self.contour.data)
+            origins = np.empty_like(coords)
+            targets = np.empty_like(coords)
+            crossing = np.zeros(len(coords), dtype=bool)
+            locations, rotations = [], []
+            # Only retry the second diagonal on vertices the first one did not straddle
+            for p1, p2 in NORMAL_SAMPLE_OFFSETS:
+                pending = np.flatnonzero(~crossing)
+                v1, v2 = coords[pending] + p1, coords[pending] + p2
+                inside1, inside2 = inside_mask(self._bvh, v1), inside_mask(self._bvh, v2)
+                # Cast from the sample outside the mesh towards the one inside
+                origins[pending] = np.where(inside1[:, None], v2, v1)
+                targets[pending] = np.where(inside1[:, None], v1, v2)
+                crossing[pending[inside1 ^ inside2]] = True
+
+            for i in tqdm(np.flatnonzero(crossing), desc="Sampling for normals"):
+                hit, location, normal, face_index = ray_cast_from_to(Vector(origins[i]), Vector(targets[i]), self.TARGET)
+                if hit: 
                     rotation_euler = normal.to_track_quat('Z', 'Y').to_euler("XYZ")
                     location = location + (normal * offset)
-                    self._keypoints.append([location, rotation_euler])
-            logger.info(f"Sampled {len(self._keypoints)} normals")
+                    locations.append(location[:])
+                    rotations.append(rotation_euler[:])
+            self._loc = np.array(locations, dtype=np.float64).reshape(-1, 3)
+            self._rot = np.array(rotations, dtype=np.float64).reshape(-1, 3)
+            logger.info(f"Sampled {len(self._loc)} normals")
         except Exception as e:
             logger.error(f"Error in sampling for normals: {str(e)}")
             raise
 
-    def get_contour(self):
-        try:
+    def slice(self, bm=None):
+        """
+        Bisects a bmesh of the target down to its cross-section with the task's plane,
+        reading the target mesh only when no bm is given
+        """
+        if bm is None:
             bm = bmesh.new()
             bm.from_mesh(self.TARGET.data)
-           
-            cut = bmesh.ops.bisect_plane(
-                    bm,
-                    plane_co=self.center,
-                    plane_no=self.plane_normal,
-                    geom=bm.verts[:] + bm.faces[:] + bm.edges[:],
-                    clear_inner=True,
-                    clear_outer=True,
-                    )["geom_cut"]
+
+        # All three are needed, bisect_plane only cuts the given edges and faces and clears the given verts
+        cut = bmesh.ops.bisect_plane(
+                bm,
+                plane_co=self.center,
+                plane_no=self.plane_normal,
+                geom=[*bm.faces, *bm.edges, *bm.verts],
+                clear_inner=True,
+                clear_outer=True,
+                )["geom_cut"]
+        if cut:
+            # Same as a level 4 simple subdivision, 2**4 - 1 cuts per edge
+            bmesh.ops.subdivide_edges(bm, edges=bm.edges[:], cuts=15, use_grid_fill=False)
+        self._slice = (bm, cut)
+        return self._slice
+
+    def get_contour(self):
+        try:
+            if self._slice is None:
+                self.slice()
+            bm, cut = self._slice
+            self._slice = None
             
             if not cut:
-                bm.clear()
+                bm.free()
                 logger.warning("No contour found")
                 return
             
@@ -111,14 +156,9 @@ class ContourTrace(CAMTask):
             slice = bpy.data.objects.new(f"Slice", me)
             slice.matrix_world = self.TARGET.matrix_world
             self.contour = slice
-            bm.clear()   
+            bm.free()   
             
-            slice.modifiers.new(name='Subdivision', type='SUBSURF')
-            slice.modifiers["Subdivision"].levels = 4
-            slice.modifiers["Subdivision"].subdivision_type = 'SIMPLE'
             bpy.context.scene.collection.objects.link(slice)
-            bpy.context.view_layer.objects.active = slice
-            bpy.ops.object.modifier_apply(modifier="Subdivision")
             logger.info("Contour created successfully")
         except Exception as e:
             logger.error(f"Error in getting contour: {str(e)}")
@@ -127,13 +167,10 @@ class ContourTrace(CAMTask):
     def _build(self):
         self.get_contour()
         if self.contour is not None:
-            def get_angle_z(obj):
-                location, rotation = obj
-                return math.atan2(location.y, location.x)
-
             self.sample_for_normals(offset=.0)
-            self._keypoints = sorted(self._keypoints, key=get_angle_z)
-            self._keypoints = minimize_objects_angular_distance(self._keypoints)
+            order = angular_order(self._loc)
+            self._loc, self._rot = self._loc[order], self._rot[order]
+            minimize_objects_angular_distance(self._rot)
 
 class MultiContourTrace(CAMTask):
     def __init__(self, target, tool, start=Vector((0,0,0)), height=10, cuts=1, plane_normal=Vector((0,0,1))):
@@ -144,10 +181,10 @@ class MultiContourTrace(CAMTask):
         self.height = height
         
     def get_keypoints(self):
-        points = []
-        for task in self.sub_tasks:
-            points += task.get_keypoints()
-        return points
+        if not self.sub_tasks:
+            return super().get_keypoints()
+        locations, rotations = zip(*(task.get_keypoints() for task in self.sub_tasks))
+        return np.concatenate(locations), np.concatenate(rotations)
     
     def _build(self):
         start = self.start
@@ -157,9 +194,14 @@ class MultiContourTrace(CAMTask):
         axis = end - start
         dv = axis / self.cuts
         
+        # Read the target mesh once, each plane bisects its own copy
+        base = bmesh.new()
+        base.from_mesh(self.TARGET.data)
         for i in tqdm(range(self.cuts + 1), desc="Building multi-contour trace"):
             plane_co = self.start + i * dv
-            task = ContourTrace(self.TARGET, self.TOOL, center=plane_co, plane_normal=axis)
+            task = ContourTrace(self.TARGET, self.TOOL, center=plane_co, plane_normal=axis, bvh=self._bvh)
+            task.slice(base.copy())
             task.build()
             self.sub_tasks.append(task)
+        base.free()
         logger.info(f"Built multi-contour trace with {len(self.sub_tasks)} sub-tasks")
\ No newline at end of file
@@ -1,47 +1,71 @@
 import bpy, bmesh
 from mathutils import Vector, Euler
-import math
+from mathutils.bvhtree import BVHTree
+import numpy as np
+
+# Parity rays for pointInsideMeshParity, +Z first and X only when +Z sees nothing
+PARITY_AXES = ( Vector((0,0,1)) , Vector((1,0,0)) )
+# Relative slack when deciding whether the nearest point on the mesh lies inside a face
+NEAREST_FACE_EPS = 1e-4
+
+def vertex_coords(mesh):
+    """
+    Returns the mesh vertex coordinates as an (N,3) array
+    """
+    flat = np.empty(len(mesh.vertices) * 3, dtype=np.float64)
+    mesh.vertices.foreach_get("co", flat)
+    return flat.reshape(-1, 3)
+
 def snap_object_to_origin(object):
     ######## Snap Target to zero
-    minz = 1e8
-    maxz = -1
-    for vertex in object.data.vertices:
-        # object vertices are in object space, translate to world space
-        v_world = object.matrix_world @ Vector((vertex.co[0],vertex.co[1],vertex.co[2]))
-        if v_world[2] < minz:
-            minz = v_world[2]
-        if v_world[2] > maxz:
-            maxz = v_world[2]
+    # object vertices are in object space, only the world z row is needed
+    matrix = np.array(object.matrix_world)
+    minz = (vertex_coords(object.data) @ matrix[2, :3] + matrix[2, 3]).min()
     object.location.z = object.location.z - minz
     bpy.ops.object.transform_apply(location=True, rotation=True, scale=True)
 
-def minimize_objects_angular_distance(objects):
-    for i in range(1, len(objects)):
-        for ax in range(3):
-            diff = objects[i][1][ax] - objects[i-1][1][ax]
-            diff = diff % (2*math.pi)
-            if diff > math.pi:
-                diff -= 2*math.pi
-            elif diff < -math.pi:
-                diff += 2*math.pi
-            objects[i][1][ax] = objects[i-1][1][ax] + diff
-    return objects
-
-def pointInsideMesh(point, object):
-    axes = [ Vector((1,0,0)) , Vector((0,1,0)), Vector((0,0,1))  ]
-    outside = False
-    for axis in axes:
+def angular_order(locations):
+    """
+    Returns the indices that sort the (N,3) locations by their angle about the Z axis
+    """
+    # Stable like the sorted() it replaced, so keypoints at the same angle keep their sample order
+    return np.argsort(np.arctan2(locations[:, 1], locations[:, 0]), kind="stable")
+
+def minimize_objects_angular_distance(rotations):
+    # Unwrap each axis of the (N,3) rotations in place so consecutive keypoints never jump by more than pi
+    if len(rotations) > 1:
+        rotations[:] = np.unwrap(rotations, axis=0)
+    return rotations
+
+def pointInsideMesh(point, bvh):
+    # A point is inside when it lies behind the closest face of the mesh
+    location, normal, index, dist = bvh.find_nearest(point)
+    if index is None:
+        return pointInsideMeshParity(point, bvh)
+    side = (Vector(point) - location).dot(normal)
+    # The offset is only parallel to the normal inside a face, on an edge or vertex the returned face is arbitrary
+    if abs(side) < (1 - NEAREST_FACE_EPS) * dist:
+        return pointInsideMeshParity(point, bvh)
+    return side < 0
+
+def pointInsideMeshParity(point, bvh):
+    for axis in PARITY_AXES:
         orig = point
         count = 0
         while True:
-            hit,location,normal,index = object.ray_cast(orig,orig+axis*10000.0)
-            if index == -1: break
+            location,normal,index,dist = bvh.ray_cast(orig,axis)
+            if index is None: break
             count += 1
             orig = location + axis*0.00001
-        if count%2 == 0:
-            outside = True
-            break
-    return not outside
+        if count:
+            return count%2 == 1
+    return False
+
+def inside_mask(bvh, points):
+    """
+    Returns a boolean array flagging which rows of an (N,3) array are inside the mesh
+    """
+    return np.fromiter((pointInsideMesh(Vector(point), bvh) for point in points), dtype=bool, count=len(points))
 
 def bmesh_copy_from_object(obj, transform=True, triangulate=True, apply_modifiers=False):
     """
@@ -80,6 +104,56 @@ def bmesh_copy_from_object(obj, transform=True, triangulate=True, apply_modifier
 
     return bm
 
+def build_bvh(obj):
+    """
+    Returns a world space bmesh copy of the object and a BVHTree built from it
+    """
+    # BVHTree triangulates internally
+    bm = bmesh_copy_from_object(obj, transform=True, triangulate=False)
+    return bm, BVHTree.FromBMesh(bm)
+
+def rest_geometry(obj):
+    """
+    Returns the object space vertices as an (N,3) array and the polygon vertex indices
+    """
+    bm = bmesh_copy_from_object(obj, transform=False, triangulate=False)
+    bm.verts.index_update()
+    verts = np.array([v.co[:] for v in bm.verts], dtype=np.float64).reshape(-1, 3)
+    polygons = [[v.index for v in f.verts] for f in bm.faces]
+    bm.free()
+    return verts, polygons
+
+def transform_points(points, matrix):
+    """
+    Returns the (N,3) points moved by a 4x4 matrix
+    """
+    matrix = np.array(matrix)
+    return np.asarray(points, dtype=np.float64) @ matrix[:3, :3].T + matrix[:3, 3]
+
+def posed_bvh(verts, polygons, matrix):
+    """
+    Returns a BVHTree of the rest geometry moved by matrix, the object itself is left untouched
+    """
+    return BVHTree.FromPolygons(transform_points(verts, matrix).tolist(), polygons)
+
+def posed_bounds(bound_box, matrix):
+    """
+    Returns the min and max corners of the axis aligned box around bound_box moved by matrix
+    """
+    corners = transform_points(bound_box, matrix)
+    return corners.min(axis=0), corners.max(axis=0)
+
+def aabb_overlap(min_a, max_a, min_b, max_b):
+    return bool(np.all(max_a >= min_b) and np.all(min_a <= max_b))
+
+def bvh_intersect(bvh, bvh2):
+    """
+    Check if any faces of the two trees intersect
+
+    returns a boolean
+    """
+    return bool(bvh.overlap(bvh2))
+
 def bmesh_check_intersect_objects(obj, obj2):
     # https://blender.stackexchange.com/questions/9073/how-to-check-if-two-meshes-intersect-in-python
     """
@@ -89,51 +163,13 @@ def bmesh_check_intersect_objects(obj, obj2):
     """
     assert(obj != obj2)
 
-    # Triangulate
-    bm = bmesh_copy_from_object(obj, transform=True, triangulate=True)
-    bm2 = bmesh_copy_from_object(obj2, transform=True, triangulate=True)
+    bm, bvh = build_bvh(obj)
+    bm2, bvh2 = build_bvh(obj2)
 
-    # If bm has more edges, use bm2 instead for looping over its edges
-    # (so we cast less rays from the simpler object to the more complex object)
-    if len(bm.edges) > len(bm2.edges):
-        bm2, bm = bm, bm2
+    intersect = bvh_intersect(bvh, bvh2)
 
-    # Create a real mesh (lame!)
-    scene = bpy.context.scene
-    me_tmp = bpy.data.meshes.new(name="~temp~")
-    bm2.to_mesh(me_tmp)
+    bm.free()
     bm2.free()
-    obj_tmp = bpy.data.objects.new(name=me_tmp.name, object_data=me_tmp)
-    # scene.objects.link(obj_tmp)
-    bpy.context.collection.objects.link(obj_tmp)
-    ray_cast = obj_tmp.ray_cast
-
-    intersect = False
-
-    EPS_NORMAL = 0.000001
-    EPS_CENTER = 0.01  # should always be bigger
-
-    #for ed in me_tmp.edges:
-    for ed in bm.edges:
-        v1, v2 = ed.verts
-
-        # setup the edge with an offset
-        co_1 = v1.co.copy()
-        co_2 = v2.co.copy()
-        co_mid = (co_1 + co_2) * 0.5
-        no_mid = (v1.normal + v2.normal).normalized() * EPS_NORMAL
-        co_1 = co_1.lerp(co_mid, EPS_CENTER) + no_mid
-        co_2 = co_2.lerp(co_mid, EPS_CENTER) + no_mid
-
-        success, co, no, index = ray_cast(co_1, (co_2 - co_1).normalized(), distance = ed.calc_length())
-        if index != -1:
-            intersect = True
-            break
-
-    # scene.objects.unlink(obj_tmp)
-    bpy.context.collection.objects.unlink(obj_tmp)
-    bpy.data.objects.remove(obj_tmp)
-    bpy.data.meshes.remove(me_tmp)
     return intersect
 
 def ray_cast_from_to(origin, target, collision_object, mark=True):
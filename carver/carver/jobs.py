@@ -1,5 +1,6 @@
 import bpy
-from mathutils import Vector
+from mathutils import Vector, Euler
+import numpy as np
 from tqdm import tqdm
 import logging
 
@@ -7,6 +8,9 @@ import logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# (data_path, index) of every fcurve animate() writes, in keypoint column order
+KEYFRAME_CHANNELS = [("location", i) for i in range(3)] + [("rotation_euler", i) for i in range(3)]
+
 class XYZIJK_Job:
     def __init__(self, target, tool, tasks=[], origin=Vector((0,0,0))):
         if not isinstance(target, bpy.types.Object) or not isinstance(tool, bpy.types.Object):
@@ -52,12 +56,30 @@ class XYZIJK_Job:
             line_mesh.from_pydata(verts, edges, [])
             line_mesh.update()
 
+            # Small triangle in the XY plane centred on the origin, facing +Z
+            marker_face = np.array([(1, 0, 0), (-.5, .866, 0), (-.5, -.866, 0)]) * mark_length * .1
+
             for task in tqdm(self.tasks, desc="Marking keypoints"):
-                for location, rotation_euler in task.get_keypoints():
-                    line_obj = bpy.data.objects.new("Line", line_mesh)
-                    line_obj.location =  location
-                    line_obj.rotation_euler = rotation_euler
-                    self._keypoints_collection.objects.link(line_obj)
+                locations, rotations = task.get_keypoints()
+                if not len(locations):
+                    continue
+                # One face per keypoint, its centre and normal place the instanced line
+                matrices = np.array([Euler(rotation, 'XYZ').to_matrix() for rotation in rotations])
+                verts = locations[:, None, :] + np.einsum('nij,kj->nki', matrices, marker_face)
+                faces = np.arange(len(locations) * 3).reshape(-1, 3)
+
+                instancer_mesh = bpy.data.meshes.new("KeypointsMesh")
+                instancer_mesh.from_pydata(verts.reshape(-1, 3).tolist(), [], faces.tolist())
+                instancer_mesh.update()
+                instancer = bpy.data.objects.new("Keypoints", instancer_mesh)
+                instancer.instance_type = 'FACES'
+                instancer.show_instancer_for_viewport = False
+                instancer.show_instancer_for_render = False
+
+                line_obj = bpy.data.objects.new("Line", line_mesh)
+                line_obj.parent = instancer
+                self._keypoints_collection.objects.link(instancer)
+                self._keypoints_collection.objects.link(line_obj)
             
             logger.info(f"Keypoints marked successfully")
         except Exception as e:
@@ -67,27 +89,24 @@ class XYZIJK_Job:
     def animate(self):
         try:
             self.TOOL.animation_data_clear()
-            frame_num = 0
-            total_keypoints = sum(len(list(task.get_keypoints())) for task in self.tasks)
+            locations, rotations = np.empty((0, 3)), np.empty((0, 3))
+            if self.tasks:
+                locations, rotations = (np.concatenate(column) for column in zip(*(task.get_keypoints() for task in self.tasks)))
+            # Convert relative locations to global coordinates
+            values = np.hstack((locations + np.array(self.TARGET.location), rotations))
+            total_keypoints = len(values)
             
-            with tqdm(total=total_keypoints, desc="Animating tool") as pbar:
-                for task in self.tasks:
-                    for location, rotation_euler in task.get_keypoints():
-                        frame_num += 4
-                        
-                        # Convert relative location to global coordinates
-                        global_location = self.TARGET.location + location
-                        logger.info((location, global_location))
-                        # Set the tool's position and rotation
-                        self.TOOL.location = global_location
-                        self.TOOL.rotation_euler = rotation_euler
-                        
-                        # Insert keyframes
-                        self.TOOL.keyframe_insert(data_path='location', frame=frame_num)
-                        self.TOOL.keyframe_insert(data_path='rotation_euler', frame=frame_num)
-                        
-                        pbar.update(1)
+            # Insert all keyframes per fcurve at once instead of one keyframe_insert per keypoint
+            frames = np.arange(1, total_keypoints + 1, dtype=np.float64) * 4
+            action = bpy.data.actions.new(f"{self.TOOL.name}Action")
+            self.TOOL.animation_data_create().action = action
+            for column, (data_path, index) in enumerate(KEYFRAME_CHANNELS):
+                fcurve = action.fcurves.new(data_path, index=index)
+                fcurve.keyframe_points.add(total_keypoints)
+                fcurve.keyframe_points.foreach_set("co", np.column_stack((frames, values[:, column])).ravel())
+                fcurve.update()
             
+            frame_num = total_keypoints * 4
             bpy.context.scene.frame_end = frame_num
             logger.info(f"Tool animation completed with {frame_num} frames")
         except Exception as e: